@@ -2,81 +2,124 @@ import multiprocessing as mp
 import os
 import pickle
 import gc
+from typing import Optional, Tuple, Dict
 
+from diskcache import Cache
 from tqdm import tqdm
-from tqdm.contrib.concurrent import process_map
 
 from data_model.dataset import Table, Entity
 from datasets import DatasetEnum
 from generators import EmbeddingCandidateGenerator, Generator, HybridGenerator, HybridGeneratorSimulator
-from pathlib import Path
 
 
 class CEAAnnotator:
     def __init__(self,
                  generator: Generator,
-                 max_workers: int = mp.cpu_count()):
+                 max_workers: int = mp.cpu_count(),
+                 chunksize: Optional[int] = None,
+                 start_method: Optional[str] = None):
         """
         :param generator:
         :param max_workers: max number of workers used to parallelize the annotation
+        :param chunksize: number of tables sent to a worker at once. Default: tables / (4 * max_workers)
+        :param start_method: multiprocessing start method of the workers. Default: the platform default.
+               With forkserver, the heavy modules are preloaded once in the server process, instead of being
+               re-imported by every worker as in spawn. fork (workers inherit the parent state copy-on-write)
+               must be explicitly requested: it is unsafe once TF/torch threads are running, e.g., on macOS.
         """
         assert max_workers > 0
+        assert chunksize is None or chunksize > 0
+        assert start_method is None or start_method in mp.get_all_start_methods()
         self._generator = generator
         self._max_workers = max_workers
+        self._chunksize = chunksize
+        self._start_method = start_method
+        self._caches: Dict[Tuple[str, str], Cache] = {}
 
     @property
     def generator_id(self):
         return self._generator.id
 
-    def annotate_table(self, table: Table):
-
-        folder_path = os.path.join(os.path.dirname(__file__),
-                                   'annotations',
-                                   table.dataset_id,
-                                   self._generator.id)
-        Path(folder_path).mkdir(parents=True, exist_ok=True)
-
-        filename = os.path.join(folder_path, '%s.pkl' % table.tab_id)
+    def _annotations_cache(self, dataset_id: str, generator_id: str) -> Cache:
+        """
+        Return the cache of the tables of a dataset annotated by a generator.
+        All the tables are stored in a single SQLite database, instead of one file per table.
+        :param dataset_id: the dataset id
+        :param generator_id: the generator id
+        :return: a Cache object
+        """
+        key = (dataset_id, generator_id)
+        if key not in self._caches:
+            self._caches[key] = Cache(os.path.join(os.path.dirname(__file__), 'annotations', dataset_id, generator_id),
+                                      eviction_policy='none',  # results must never be dropped
+                                      disk_min_file_size=2 ** 30)  # keep tables in the database, not in files
+        return self._caches[key]
+
+    def _get_annotated_table(self, dataset_id: str, generator_id: str, tab_id: str) -> Optional[Table]:
+        """
+        Retrieve an already annotated table.
+        :param dataset_id: the dataset id
+        :param generator_id: the generator id
+        :param tab_id: the table id
+        :return: the annotated table, None if missing
+        """
+        cache = self._annotations_cache(dataset_id, generator_id)
+        table = cache.get(tab_id)
+        if table is None:  # results computed before the cache was introduced (one pickle per table)
+            try:
+                with open(os.path.join(cache.directory, '%s.pkl' % tab_id), 'rb') as f:
+                    table = pickle.load(f)
+                cache.set(tab_id, table)
+            except FileNotFoundError:
+                pass
+        return table
 
+    def annotate_table(self, table: Table):
         # check existing result
-        if not os.path.exists(filename):
-
-            # keep the cell-search_key pair -> results may be shuffled!
-            search_key_cell_dict = table.get_search_keys_cells_dict()
-
-            if isinstance(self._generator, HybridGenerator):
-                # try to reuse already annotated tables
-                tables = []
-                for generator in self._generator.generators:
-                    subfolder_path = os.path.join(os.path.dirname(__file__),
-                                                  'annotations',
-                                                  table.dataset_id,
-                                                  generator.id)
-                    subfilename = os.path.join(subfolder_path, '%s.pkl' % table.tab_id)
-
-                    if not os.path.exists(subfilename):
-                        break
-
-                    tables.append(pickle.load(open(subfilename, 'rb')))
-
-                if len(tables) == len(self._generator.generators):
-                    results = HybridGeneratorSimulator.get_candidates(*tables)  # combine results from many tables
-                else:
-                    results = self._generator.get_candidates(table)
-
+        annotated_table = self._get_annotated_table(table.dataset_id, self.generator_id, table.tab_id)
+        if annotated_table is not None:
+            return annotated_table
+
+        # keep the cell-search_key pair -> results may be shuffled!
+        search_key_cell_dict = table.get_search_keys_cells_dict()
+
+        if isinstance(self._generator, HybridGenerator):
+            # try to reuse already annotated tables
+            tables = []
+            for generator in self._generator.generators:
+                annotated_table = self._get_annotated_table(table.dataset_id, generator.id, table.tab_id)
+                if annotated_table is None:
+                    break
+                tables.append(annotated_table)
+
+            if len(tables) == len(self._generator.generators):
+                results = HybridGeneratorSimulator.get_candidates(*tables)  # combine results from many tables
             else:
                 results = self._generator.get_candidates(table)
 
-            for search_key, candidates in results:
-                if candidates:
-                    for cell in search_key_cell_dict[search_key]:
-                        table.annotate_cell(cell, Entity(candidates[0]))  # first candidate = best
+        else:
+            results = self._generator.get_candidates(table)
 
-            pickle.dump(table, open(filename, 'wb'))
+        for search_key, candidates in results:
+            if candidates:
+                for cell in search_key_cell_dict[search_key]:
+                    table.annotate_cell(cell, Entity.intern(candidates[0]))  # first candidate = best
 
-            gc.collect()
+        self._annotations_cache(table.dataset_id, self.generator_id).set(table.tab_id, table)
 
-        return pickle.load(open(filename, 'rb'))
+        gc.collect()
+
+        return table
+
+    def _annotate_table_by_id(self, task: Tuple[str, DatasetEnum]):
+        """
+        Load a table inside the worker and annotate it.
+        Only the pair (tab_id, dataset) crosses the process boundary, instead of the whole pickled table.
+        :param task: a pair (tab_id, dataset)
+        :return: the annotated table
+        """
+        tab_id, dataset = task
+        return self.annotate_table(dataset.load_table(tab_id))
 
     def annotate_dataset(self, dataset: DatasetEnum):
         """
@@ -92,10 +135,18 @@ class CEAAnnotator:
             new_annotated_tables = []
             for table in tqdm(tables, total=total_tables):
                 new_annotated_tables.append(self.annotate_table(table))
-        else:  # Parallelize: 1 table per process
-            new_annotated_tables = process_map(self.annotate_table,
-                                               tables,
-                                               max_workers=self._max_workers,
-                                               total=total_tables)
+        else:  # Parallelize: batches of tables per process
+            if isinstance(dataset, DatasetEnum):  # send ids only, workers load tables from disk
+                func = self._annotate_table_by_id
+                tasks = ((tab_id, dataset) for tab_id in dataset.iter_table_ids())
+            else:  # test datasets are created on-the-fly and cannot be pickled by reference
+                func, tasks = self.annotate_table, tables
+            chunksize = self._chunksize or max(1, total_tables // (self._max_workers * 4))
+            context = mp.get_context(self._start_method)
+            if self._start_method == 'forkserver':
+                context.set_forkserver_preload(['annotators', 'generators', 'utils.embeddings', 'utils.kgs'])
+            with context.Pool(self._max_workers) as pool:
+                new_annotated_tables = list(tqdm(pool.imap_unordered(func, tasks, chunksize=chunksize),
+                                                 total=total_tables))
 
         return new_annotated_tables
@@ -1,3 +1,5 @@
+from collections import defaultdict
+from multiprocessing.reduction import ForkingPickler
 from typing import List, Dict, Tuple, Iterable, NamedTuple
 
 import pandas as pd
@@ -57,16 +59,9 @@ class Table:
         self._dataset_id = dataset_id
 
         # cell values
-        try:
-            self._df = pd.read_csv(csv_path, header=None, keep_default_na=False, escapechar='\\', dtype=str)
-            self._gap = 0
-        except ParserError:
-            # Some tables are not VALID CSVs because of:
-            # - a title row (not commented out), e.g., %C3%93scar_Rivas#0.csv in CEA_Round2
-            # - a wrong header, e.g., 10th_Canadian_Parliament#1.csv in CEA_Round2
-            self._df = pd.read_csv(csv_path, header=None, keep_default_na=False, escapechar='\\', dtype=str, skiprows=1)
-            self._gap = 1
-        self._df = self._df.applymap(lambda x: x.replace('""', ''))  # Pandas missplaces quotes in quoted fields
+        self._csv_path = csv_path
+        self._df_cache, self._gap = self._read_csv(csv_path)
+        self._search_keys: Dict[Cell, SearchKey] = {}  # computed on demand, not pickled
 
         # annotations (predictions)
         self._cell_annotations: Dict[Cell, CellAnnotation] = {}
@@ -77,6 +72,41 @@ class Table:
         self._gt_column_annotations: Dict[Column, ColumnAnnotation] = {}
         self._gt_property_annotations: Dict[ColumnRelation, PropertyAnnotation] = {}
 
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_search_keys'] = {}
+        return state
+
+    def __setstate__(self, state):
+        if '_df' in state:  # tables pickled before the cell values were loaded lazily
+            state['_df_cache'] = state.pop('_df')
+        state.setdefault('_search_keys', {})
+        self.__dict__.update(state)
+
+    @staticmethod
+    def _read_csv(csv_path: str) -> Tuple[pd.DataFrame, int]:
+        """
+        Read the cell values of a table.
+        :param csv_path: path of the CSV file
+        :return: a pair (<dataframe>, <number of skipped rows>)
+        """
+        try:
+            df = pd.read_csv(csv_path, header=None, keep_default_na=False, escapechar='\\', dtype=str)
+            gap = 0
+        except ParserError:
+            # Some tables are not VALID CSVs because of:
+            # - a title row (not commented out), e.g., %C3%93scar_Rivas#0.csv in CEA_Round2
+            # - a wrong header, e.g., 10th_Canadian_Parliament#1.csv in CEA_Round2
+            df = pd.read_csv(csv_path, header=None, keep_default_na=False, escapechar='\\', dtype=str, skiprows=1)
+            gap = 1
+        return df.applymap(lambda x: x.replace('""', '')), gap  # Pandas missplaces quotes in quoted fields
+
+    @property
+    def _df(self) -> pd.DataFrame:
+        if self._df_cache is None:  # dropped when sent to another process, see _reduce_table
+            self._df_cache, self._gap = self._read_csv(self._csv_path)
+        return self._df_cache
+
     @property
     def tab_id(self) -> str:
         return self._tab_id
@@ -116,17 +146,19 @@ class Table:
         return self._df[col_id]
 
     def get_search_key(self, cell: Cell) -> SearchKey:
-        row = self.get_row(cell.row_id)
-        return SearchKey(row[cell.col_id],
-                         tuple(row[self._df.columns.drop(cell.col_id)].to_dict().items()))
+        # both the annotator and the generators ask for the search keys of the same cells: compute them once
+        search_key = self._search_keys.get(cell)
+        if search_key is None:
+            row = self.get_row(cell.row_id)
+            search_key = self._search_keys[cell] = SearchKey(
+                row[cell.col_id],
+                tuple(row[self._df.columns.drop(cell.col_id)].to_dict().items()))
+        return search_key
 
     def get_search_keys_cells_dict(self) -> Dict[SearchKey, List[Cell]]:
-        search_keys_dict = {}
+        search_keys_dict = defaultdict(list)
         for cell in self._gt_cell_annotations:
-            search_key = self.get_search_key(cell)
-            if search_key not in search_keys_dict:
-                search_keys_dict[search_key] = []
-            search_keys_dict[search_key].append(cell)
+            search_keys_dict[self.get_search_key(cell)].append(cell)
         return search_keys_dict
 
     def get_annotated_cells(self) -> List[Cell]:
@@ -164,7 +196,7 @@ class Table:
         """
         self._gt_cell_annotations = {cell_annotation.cell: cell_annotation
                                      for cell_annotation in [CellAnnotation(Cell(triple[0], triple[1]),
-                                                                            [Entity(e) for e in triple[2]])
+                                                                            [Entity.intern(e) for e in triple[2]])
                                                              for triple in triples]}
 
     def set_gt_column_annotations(self, pairs: Iterable[Tuple[int, List[str], List[str]]]):
@@ -191,6 +223,28 @@ class Table:
                                                              [Property(e) for e in triple[2]])
                                           for triple in triples]}
 
+
+def _rebuild_table(state) -> Table:
+    table = Table.__new__(Table)
+    table.__setstate__(state)
+    return table
+
+
+def _reduce_table(table: Table):
+    """
+    Pickle a table for inter-process communication without its cell values (re-read from the CSV file on access).
+    Only multiprocessing uses this reducer: tables pickled to disk keep their values.
+    :param table: a Table object
+    :return: a reduce tuple
+    """
+    state = table.__getstate__()
+    if state.get('_csv_path'):
+        state['_df_cache'] = None
+    return _rebuild_table, (state,)
+
+
+ForkingPickler.register(Table, _reduce_table)
+
 # class OldTable:
 #     def __init__(self, tab_id: str, dataset: DatasetEnum, filepath: str):
 #         super().__init__(tab_id, dataset)
@@ -1,6 +1,7 @@
+from functools import lru_cache
 from urllib.parse import unquote
 from dataclasses import dataclass
-from typing import NamedTuple
+from typing import NamedTuple, Dict
 
 
 @dataclass
@@ -9,18 +10,49 @@ class DBpediaWrapperConfig:
     index: str = 'dbpedia'
     sparql_endpoint: str = 'http://dbpedia.org/sparql'
     default_graph: str = 'http://dbpedia.org'
+    sparql_timeout: float = 120  # seconds to wait for a response of the SPARQL endpoint
+
+
+@lru_cache(maxsize=1 << 16)
+def _normalize_uri(uri: str) -> str:
+    """
+    Decode and lowercase a URI. Cached, since the same URIs are compared over and over.
+    :param uri: a URI
+    :return: the normalized URI
+    """
+    return unquote(uri).lower()
 
 
 class Entity(NamedTuple):
     uri: str
 
+    @property
+    def norm_uri(self) -> str:
+        return _normalize_uri(self.uri)
+
     def __eq__(self, o: object) -> bool:
         if isinstance(o, Entity):
-            return unquote(self.uri).lower() == unquote(o.uri).lower()
+            return self.norm_uri == o.norm_uri
         return False
 
     def __hash__(self) -> int:
-        return hash(unquote(self.uri).lower())
+        return hash(self.norm_uri)
+
+    @classmethod
+    def intern(cls, uri: str) -> 'Entity':
+        """
+        Return the shared Entity instance for a URI, creating it on the first call.
+        The same URIs occur in many cells: sharing instances saves allocations, and pickle stores them once.
+        :param uri: a URI
+        :return: an Entity
+        """
+        entity = _ENTITIES_POOL.get(uri)
+        if entity is None:
+            entity = _ENTITIES_POOL[uri] = cls(uri)
+        return entity
+
+
+_ENTITIES_POOL: Dict[str, Entity] = {}
 
 
 class Class(NamedTuple):
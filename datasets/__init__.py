@@ -19,6 +19,10 @@ TT_CATEGORIES = {'ALL': ([], []),
                  'TOUGH_NOISE2': (['TOUGH', 'NOISE2'], [])
                  }
 
+GT_COLUMNS = {'CEA': {'tab_id': str, 'col_id': int, 'row_id': int, 'entities': str},
+              'CTA': {'tab_id': str, 'col_id': int, 'perfect': str, 'okay': str},
+              'CPA': {'tab_id': str, 'source_id': int, 'target_id': int, 'properties': str}}
+
 
 class DatasetEnum(Enum):
     """
@@ -47,53 +51,77 @@ class DatasetEnum(Enum):
                           usecols=['tab_id'])
         return len(cea['tab_id'].unique())
 
-    def _tables_to_pkl(self):
-        cea = pd.read_csv(self._gt_path('CEA'),
-                          names=['tab_id', 'col_id', 'row_id', 'entities'],
-                          dtype={'tab_id': str, 'col_id': int, 'row_id': int, 'entities': str})
-        cea['entities'] = cea['entities'].apply(str.split)
-        cta_groups = None
-        if os.path.exists(self._gt_path('CTA')):
-            cta = pd.read_csv(self._gt_path('CTA'),
-                              names=['tab_id', 'col_id', 'perfect', 'okay'],
-                              dtype={'tab_id': str, 'col_id': int, 'perfect': str, 'okay': str},
-                              keep_default_na=False)  # the "okay" value might be empty
-            cta['perfect'] = cta['perfect'].apply(str.split)
-            cta['okay'] = cta['okay'].apply(str.split)
-            cta_groups = cta.groupby('tab_id')
-        cpa_groups = None
-        if os.path.exists(self._gt_path('CPA')):
-            cpa = pd.read_csv(self._gt_path('CPA'),
-                              names=['tab_id', 'source_id', 'target_id', 'properties'],
-                              dtype={'tab_id': str, 'source_id': int, 'target_id': int, 'properties': str})
-            cpa['properties'] = cpa['properties'].apply(str.split)
-            cpa_groups = cpa.groupby('tab_id')
+    def _read_gt(self, task):
+        """
+        Read the GT of a task. Lists of URIs are left as space-separated strings: split them table by table,
+        instead of materializing a list for each row of the whole file.
+        :param task: one of CEA, CTA, CPA
+        :return: a Pandas dataframe, None if the dataset has no GT for the task
+        """
+        if not os.path.exists(self._gt_path(task)):
+            return None
+        return pd.read_csv(self._gt_path(task),
+                           names=list(GT_COLUMNS[task]),
+                           dtype=GT_COLUMNS[task],
+                           keep_default_na=False)  # e.g., the CTA "okay" value might be empty
 
-        cea_groups = cea.groupby('tab_id')
-        for tab_id, cea_group in cea_groups:
+    def _tables_to_pkl(self):
+        cea = self._read_gt('CEA')
+        cta = self._read_gt('CTA')
+        cpa = self._read_gt('CPA')
+
+        # index raw arrays by the row positions of each table, instead of materializing groups
+        cea_cols = {col: cea[col].to_numpy() for col in cea.columns}
+        cta_cols = {col: cta[col].to_numpy() for col in cta.columns} if cta is not None else {}
+        cta_indices = cta.groupby('tab_id').indices if cta is not None else {}
+        cpa_cols = {col: cpa[col].to_numpy() for col in cpa.columns} if cpa is not None else {}
+        cpa_indices = cpa.groupby('tab_id').indices if cpa is not None else {}
+
+        for tab_id, idx in cea.groupby('tab_id').indices.items():
             table = Table(tab_id, self.value, self._table_path(tab_id))
-            table.set_gt_cell_annotations(zip(cea_group['row_id'], cea_group['col_id'], cea_group['entities']))
-            if cta_groups and tab_id in cta_groups.groups:
-                cta_group = cta_groups.get_group(tab_id)
-                table.set_gt_column_annotations(zip(cta_group['col_id'], cta_group['perfect'], cta_group['okay']))
-            if cpa_groups and tab_id in cpa_groups.groups:
-                cpa_group = cpa_groups.get_group(tab_id)
-                table.set_gt_property_annotations(zip(cpa_group['source_id'],
-                                                      cpa_group['target_id'],
-                                                      cpa_group['properties']))
-
-            pickle.dump(table, open(f"{self._pickle_table_folder_path()}/{table.tab_id}.pkl", 'wb'))
-
-    def get_tables(self):
+            table.set_gt_cell_annotations(zip(cea_cols['row_id'][idx].tolist(),
+                                              cea_cols['col_id'][idx].tolist(),
+                                              map(str.split, cea_cols['entities'][idx])))
+            if tab_id in cta_indices:
+                idx = cta_indices[tab_id]
+                table.set_gt_column_annotations(zip(cta_cols['col_id'][idx].tolist(),
+                                                    map(str.split, cta_cols['perfect'][idx]),
+                                                    map(str.split, cta_cols['okay'][idx])))
+            if tab_id in cpa_indices:
+                idx = cpa_indices[tab_id]
+                table.set_gt_property_annotations(zip(cpa_cols['source_id'][idx].tolist(),
+                                                      cpa_cols['target_id'][idx].tolist(),
+                                                      map(str.split, cpa_cols['properties'][idx])))
+
+            with open(f"{self._pickle_table_folder_path()}/{table.tab_id}.pkl", 'wb') as f:
+                pickle.dump(table, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def iter_table_ids(self):
+        """
+        Iterate over the ids of the tables in the dataset, without loading them.
+        :return: a generator of table ids
+        """
         # Precompute tables
         if not os.listdir(self._pickle_table_folder_path()):
             self._tables_to_pkl()
 
-        # Load tables from pickle files
         with os.scandir(self._pickle_table_folder_path()) as it:
             for entry in it:
                 if entry.name.endswith(".pkl") and entry.is_file():
-                    yield pickle.load(open(entry.path, 'rb'))
+                    yield entry.name[:-len(".pkl")]
+
+    def load_table(self, tab_id):
+        """
+        Load a precomputed table (with its GT annotations) from its pickle file.
+        :param tab_id: the id of the table
+        :return: a Table object
+        """
+        with open(f"{self._pickle_table_folder_path()}/{tab_id}.pkl", 'rb') as f:
+            return pickle.load(f)
+
+    def get_tables(self):
+        for tab_id in self.iter_table_ids():
+            yield self.load_table(tab_id)
 
     def get_table_categories(self):
         """
@@ -117,47 +145,37 @@ class DatasetEnum(Enum):
         """
         if from_dataset is None:
             from_dataset = cls.ST19_Round1
-        cea = pd.read_csv(from_dataset._gt_path('CEA'),
-                          names=['tab_id', 'col_id', 'row_id', 'entities'],
-                          dtype={'tab_id': str, 'col_id': int, 'row_id': int, 'entities': str})
+        cea = from_dataset._read_gt('CEA')
         if rand:
             cea = cea.sample(size).reset_index()
         else:
             cea = cea[:size]
 
-        cta_groups = None
-        if os.path.exists(from_dataset._gt_path('CTA')):
-            cta = pd.read_csv(from_dataset._gt_path('CTA'),
-                              names=['tab_id', 'col_id', 'perfect', 'okay'],
-                              dtype={'tab_id': str, 'col_id': int, 'perfect': str, 'okay': str},
-                              keep_default_na=False)  # the "okay" value might be empty
-            cta['perfect'] = cta['perfect'].apply(str.split)
-            cta['okay'] = cta['okay'].apply(str.split)
-            cta_groups = cta.groupby('tab_id')
-        cpa_groups = None
-        if os.path.exists(from_dataset._gt_path('CPA')):
-            cpa = pd.read_csv(from_dataset._gt_path('CPA'),
-                              names=['tab_id', 'source_id', 'target_id', 'properties'],
-                              dtype={'tab_id': str, 'source_id': int, 'target_id': int, 'properties': str})
-            cpa['properties'] = cpa['properties'].apply(str.split)
-            cpa_groups = cpa.groupby('tab_id')
+        cta = from_dataset._read_gt('CTA')
+        cta_groups = cta.groupby('tab_id') if cta is not None else None
+        cpa = from_dataset._read_gt('CPA')
+        cpa_groups = cpa.groupby('tab_id') if cpa is not None else None
 
         cea_groups = cea.groupby('tab_id')
         tables = []
         for tab_id, cea_group in cea_groups:
             table = Table(tab_id, f'{from_dataset.value}_test', from_dataset._table_path(tab_id))
-            table.set_gt_cell_annotations(zip(cea_group['row_id'], cea_group['col_id'], cea_group['entities']))
-            if cta_groups and tab_id in cta_groups.groups:
+            table.set_gt_cell_annotations(zip(cea_group['row_id'],
+                                              cea_group['col_id'],
+                                              cea_group['entities'].str.split()))
+            if cta_groups is not None and tab_id in cta_groups.groups:
                 cta_group = cta_groups.get_group(tab_id)
                 cta_group = cta_group[cta_group['col_id'].isin(cea_group['col_id'].unique())]
-                table.set_gt_column_annotations(zip(cta_group['col_id'], cta_group['perfect'], cta_group['okay']))
-            if cpa_groups and tab_id in cpa_groups.groups:
+                table.set_gt_column_annotations(zip(cta_group['col_id'],
+                                                    cta_group['perfect'].str.split(),
+                                                    cta_group['okay'].str.split()))
+            if cpa_groups is not None and tab_id in cpa_groups.groups:
                 cpa_group = cpa_groups.get_group(tab_id)
                 cpa_group = cpa_group[(cpa_group['source_id'].isin(cea_group['col_id'].unique()))
                                       & (cpa_group['target_id'].isin(cea_group['col_id'].unique()))]
                 table.set_gt_property_annotations(zip(cpa_group['source_id'],
                                                       cpa_group['target_id'],
-                                                      cpa_group['properties']))
+                                                      cpa_group['properties'].str.split()))
 
             tables.append(table)
 
@@ -159,7 +159,8 @@ class EmbeddingCandidateGenerator(CandidateGenerator):
         search_keys_embs = dict(cached_entries + new_results)
 
         # create embed for the candidates' abstracts
-        candidates_list = functools.reduce(operator.iconcat, lookup_results.values(), [])
+        # candidates are shared among search keys: fetch each abstract once
+        candidates_list = list(dict.fromkeys(functools.reduce(operator.iconcat, lookup_results.values(), [])))
         if self._config.abstract == 'short':
             abstracts = self._abstract_helper.fetch_short_abstracts(candidates_list)
         else:
@@ -103,7 +103,7 @@ def getTypes(uri):
     """
     abc = DBpediaWrapper()
     toRemove = ['http://www.w3.org/2002/07/owl#Thing']
-    result = abc._get_es_docs_by_ids(uri)
+    result = abc._iter_es_docs_by_ids([uri])
     types = []
     for _, doc in result:
         for x in doc['type']:
@@ -122,7 +122,7 @@ def getDescriptionTokens(uri):
     """
     abc = DBpediaWrapper()
     tokenizer = nltk.RegexpTokenizer(r"\w+")
-    result = abc._get_es_docs_by_ids(uri)
+    result = abc._iter_es_docs_by_ids([uri])
     stop_words = set(stopwords.words('english'))
 
     for _, doc in result:
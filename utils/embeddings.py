@@ -1,12 +1,16 @@
 import os
-from typing import List
+from typing import List, Dict, Optional
 
 import numpy as np
 import requests
 from gensim.models import KeyedVectors
+from requests.adapters import HTTPAdapter
 
 from utils.caching import CacheWrapper, KVPair
 
+URIS_PER_REQUEST = 500  # keep the query string of GET requests short
+MAX_VECTORS_IN_MEMORY = 100000  # bound the memory used by the in-memory copy of the cache
+
 
 class EmbeddingModel:
     def get_vectors(self, uris: List[str]):
@@ -20,25 +24,51 @@ class EmbeddingModel:
 class EmbeddingModelService(EmbeddingModel):
     def __init__(self, url):
         self._url = url
+        self._http = None  # created lazily, see _session
+        self._vectors: Dict[str, Optional[np.ndarray]] = {}  # in-memory copy of the vectors used by this process
         self._cache = CacheWrapper(os.path.join(os.path.dirname(__file__),
                                                 '.cache',
                                                 'EmbeddingModel',
                                                 self.__class__.__name__,),
                                    int(4e9))
 
+    def __getstate__(self):
+        # each process creates its own session (-> parallel execution)
+        state = self.__dict__.copy()
+        state['_http'] = None
+        state['_vectors'] = {}  # do not ship vectors to other processes
+        return state
+
+    @property
+    def _session(self) -> requests.Session:
+        """
+        HTTP session, shared by all the requests of this process to keep the connections alive.
+        :return: a Session object
+        """
+        if self._http is None:
+            self._http = requests.Session()
+            self._http.mount('http://', HTTPAdapter(pool_connections=16, pool_maxsize=64))
+            self._http.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=64))
+        return self._http
+
     def get_vectors(self, uris: List[str]):
         """
         Get vectors for the given URIs
         :param uris: a DBpedia resource URI, or a list of DBpedia resource URIs
         :return: a dict {<uri>: <vec>}. <vec> is None if it does not exist a vector for <uri>.
         """
-        cached_entries, to_compute = self._cache.get_cached_entries(uris)
-        results = dict(cached_entries)
+        results = {uri: self._vectors[uri] for uri in uris if uri in self._vectors}
+        cached_entries, to_compute = self._cache.get_cached_entries([uri for uri in dict.fromkeys(uris)
+                                                                     if uri not in results])
+        results.update(cached_entries)
         if to_compute:
-            data = {'uri': to_compute}
-            response = requests.get(self._url, params=data)
-            results.update({uri: np.array(vec) if vec else None for uri, vec in response.json().items()})
+            for i in range(0, len(to_compute), URIS_PER_REQUEST):
+                response = self._session.get(self._url, params={'uri': to_compute[i:i + URIS_PER_REQUEST]})
+                results.update({uri: np.array(vec) if vec else None for uri, vec in response.json().items()})
             self._cache.update_cache_entries([KVPair(uri, (uri, results[uri])) for uri in to_compute])
+        if len(self._vectors) + len(results) > MAX_VECTORS_IN_MEMORY:
+            self._vectors.clear()
+        self._vectors.update(results)
         return results
 
 
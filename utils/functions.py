@@ -1,19 +1,17 @@
 import re
 import string as string_utils
 from collections import Counter
+from functools import lru_cache
 from typing import List, Iterable
 from typing import Tuple, Dict, Set
 
 import nltk
 import numpy as np
-from dateutil.parser import parse
 from gensim import matutils
 from nltk.corpus import stopwords
 from nltk.tokenize import RegexpTokenizer
 from nltk.stem import PorterStemmer
 from numpy import dot
-from scipy.spatial.distance import cosine
-from sklearn.preprocessing import MinMaxScaler
 
 from data_model.generator import CandidateEmbeddings, ScoredCandidateEmbeddings
 
@@ -46,6 +44,23 @@ def get_most_frequent(list_: Iterable, n: int = 1) -> List:
     return [list(tup_) for tup_ in zip(*counter.most_common(n))][0]
 
 
+@lru_cache(maxsize=None)
+def _string_subsequences(string: str, max_subseq_len) -> Tuple[str, ...]:
+    """
+    Compute the subsequences of a string, from the longest to the shortest. Cached: labels repeat across tables.
+    :param string: a string
+    :param max_subseq_len: length of the longest subsequence to compute
+    :return: a tuple of subsequences
+    """
+    tokens = string.split()[:max(max_subseq_len, 0)]
+    if not tokens:
+        return ()
+    prefixes = [tokens[0]]
+    for token in tokens[1:]:  # build each prefix from the previous one
+        prefixes.append(prefixes[-1] + " " + token)
+    return tuple(reversed(prefixes))
+
+
 def strings_subsequences(strings: List[str], max_subseq_len) -> Tuple[Dict[str, List[str]], Set[str]]:
     """
     Given a list of strings, this method computes all the subsequences of different lengths, up to ``max_subseq_len``.
@@ -55,14 +70,8 @@ def strings_subsequences(strings: List[str], max_subseq_len) -> Tuple[Dict[str,
     :param max_subseq_len: length of the longest subsequence to compute
     :return: a tuple (<subsequences_dict>, <subsequences_set>)
     """
-    subsequences = {}
-    subsequences_set = set()
-    for string in strings:
-        tokens = string.split()
-        subsequences[string] = [" ".join(tokens[:i + 1])
-                                for i in reversed(range(min(max_subseq_len, len(tokens))))]
-        subsequences_set.update(subsequences[string])
-    return subsequences, subsequences_set
+    subsequences = {string: list(_string_subsequences(string, max_subseq_len)) for string in strings}
+    return subsequences, set().union(*subsequences.values())
 
 
 def truncate_string(string, max_tokens) -> str:
@@ -95,59 +104,90 @@ def weighting_by_ranking(candidates: List[CandidateEmbeddings],
     assert np.isnan(default_score) or default_score >= 0.0
     assert 0.0 <= alpha <= 1.0
 
-    distances = [cosine(c_emb.context_emb, c_emb.abstract_emb) for c_emb in candidates]
+    distances = _cosine_distances(candidates)
     if default_score >= 0.0:
         distances = np.nan_to_num(distances, nan=default_score)
 
-    rank_scaler = MinMaxScaler()
-    distance_scaler = MinMaxScaler()
-    rank_scaler.fit(np.arange(len(candidates)).reshape(-1, 1))
-    distance_scaler.fit(np.array(distances).reshape(-1, 1))
-
-    scored_candidates = [
-        ScoredCandidateEmbeddings(c_emb.candidate,
-                                  np.nansum([
-                                      alpha * rank_scaler.transform([[rank]])[0][0],
-                                      (1 - alpha) * distance_scaler.transform([[distances[rank]]])[0][0]
-                                  ]),
-                                  rank,
-                                  distances[rank]
-                                  )
-        for rank, c_emb in enumerate(candidates)]
+    # ranks are 0..n-1: their min-max scaling is known in advance
+    scaled_ranks = np.linspace(0.0, 1.0, len(candidates)) if len(candidates) > 1 else np.zeros(1)
+    # missing distances do not contribute to the score (as in np.nansum)
+    scores = alpha * scaled_ranks + (1 - alpha) * np.nan_to_num(_min_max_scale(distances), nan=0.0)
 
-    return sorted(scored_candidates)  # key=lambda s_cand: s_cand.score)
+    return [ScoredCandidateEmbeddings(candidates[rank].candidate, scores[rank], int(rank), distances[rank])
+            for rank in np.argsort(scores, kind='stable')]  # stable: ties keep the original rank
 
 
-def _remove_dates(input_str):
+def _cosine_distances(candidates: List[CandidateEmbeddings]) -> np.ndarray:
     """
-    Remove dates from a string.
+    Compute the cosine distance between the context and abstract embeddings of each candidate, all at once.
+    Candidates with a missing (or null) embedding get np.nan.
+    :param candidates: a list of CandidateEmbeddings
+    :return: an array of distances
+    """
+    distances = np.full(len(candidates), np.nan)
+    valid = [idx for idx, c_emb in enumerate(candidates)
+             if np.ndim(c_emb.context_emb) and np.ndim(c_emb.abstract_emb)]  # missing embeddings are np.nan
+    if valid:
+        # single precision is more than enough to rank candidates, and halves the memory traffic
+        context_embs = np.array([candidates[idx].context_emb for idx in valid], dtype=np.float32)
+        abstract_embs = np.array([candidates[idx].abstract_emb for idx in valid], dtype=np.float32)
+        with np.errstate(divide='ignore', invalid='ignore'):  # null vectors -> np.nan
+            context_embs = context_embs / np.linalg.norm(context_embs, axis=1, keepdims=True)
+            abstract_embs = abstract_embs / np.linalg.norm(abstract_embs, axis=1, keepdims=True)
+        distances[valid] = 1.0 - np.einsum('ij,ij->i', context_embs, abstract_embs)
+    return distances
+
+
+def _min_max_scale(values: np.ndarray) -> np.ndarray:
+    """
+    Scale values in [0, 1], ignoring NaNs (same behaviour of sklearn MinMaxScaler).
+    :param values: an array of values
+    :return: the scaled array
+    """
+    if np.isnan(values).all():
+        return values.astype(float)
+    min_, max_ = np.nanmin(values), np.nanmax(values)
+    range_ = max_ - min_
+    return (values - min_) / (range_ if range_ else 1.0)
+
+
+_MONTHS = r'jan(uary)?|feb(ruary)?|mar(ch)?|apr(il)?|may|june?|july?|aug(ust)?|sep(t|tember)?|oct(ober)?|' \
+          r'nov(ember)?|dec(ember)?'
+_WEEKDAYS = r'mon(day)?|tue(sday)?|wed(nesday)?|thu(rsday)?|fri(day)?|sat(urday)?|sun(day)?'
+_MONTH_DAY = r'(?:0[1-9]|1[0-2])(?:0[1-9]|[12]\d|3[01])'
+# tokens that dateutil would parse as (part of) a date: numbers, numeric dates, times, months and weekdays.
+# Suffixes like 29th and 10pm are already split by _split_dates (29 th, 10 pm)
+_DATE_RE = re.compile(r'\d{1,4}|(?:\d{2}|\d{4})' + _MONTH_DAY  # 29, 2011, 111129, 20111129
+                      + r'|\d{1,4}([-/.])\d{1,2}(\1\d{1,4})?'  # 2011-11-29, 11/29/2011, 29.11
+                      r'|\d{1,2}(:\d{2}){1,2}'  # 10:30, 10:30:15
+                      r'|' + _MONTHS + r'|' + _WEEKDAYS,
+                      re.IGNORECASE)
+_PUNCTUATION_TABLE = str.maketrans('', '', string_utils.punctuation)
+
+
+def _split_dates(input_str):
+    """
+    Split tokens where letters and digits are glued, to isolate dates.
     :param input_str: a string
     :return:
     """
     s = re.sub(r'([a-zA-Z]+)([0-9]+)', r'\1 \2',
                input_str)  # split tokens like 2011-11-29November -> 2011-11-29 November
-    s = re.sub(r'([0-9]+)([a-zA-Z]+)', r'\1 \2 ', s)  # split tokens like November2011 -> November 2011
+    return re.sub(r'([0-9]+)([a-zA-Z]+)', r'\1 \2 ', s)  # split tokens like November2011 -> November 2011
 
-    tokens = s.split()
-    f = []
-    for token in tokens:
-        try:
-            parse(token)
-        except:
-            try:
-                parse(re.sub(f"[{string_utils.punctuation}]", '', token))  # remove punctuation (?3,600 -> 3600)
-            except:
-                f.append(token)
 
-    return " ".join(f)
+@lru_cache(maxsize=1 << 16)  # tokens (years, months, common words) repeat a lot across strings
+def _is_date(token):
+    return bool(_DATE_RE.fullmatch(token)
+                or _DATE_RE.fullmatch(token.translate(_PUNCTUATION_TABLE)))  # remove punctuation (?3,600 -> 3600)
 
 
-def _remove_single_char(input_str):
-    return " ".join(filter(lambda x: len(x) > 1 or x == 'a', input_str.split()))
+def _is_single_char(token):
+    return len(token) <= 1 and token != 'a'
 
 
-def _remove_numbers(input_str):
-    return " ".join(filter(lambda x: not x.replace('.', '').replace(',', '').isdigit(), input_str.split()))
+def _is_number(token):
+    return token.replace('.', '').replace(',', '').isdigit()
 
 
 def _remove_brackets(input_str):
@@ -199,13 +239,16 @@ def simplify_string(input_str, dates=True, numbers=True, single_char=True, brack
     s = input_str
     if brackets:
         s = _remove_brackets(s)
+    if not (dates or numbers or single_char):
+        return s
     if dates:
-        s = _remove_dates(s)
-    if numbers:
-        s = _remove_numbers(s)
-    if single_char:
-        s = _remove_single_char(s)
-    return s
+        s = _split_dates(s)
+
+    # tokenize once, then apply all the token filters in a single pass
+    return " ".join(token for token in s.split()
+                    if not ((dates and _is_date(token))
+                            or (numbers and _is_number(token))
+                            or (single_char and _is_single_char(token))))
 
 
 def first_sentence(input_str, min_length=5):
@@ -1,19 +1,105 @@
 import os
-from typing import Dict, Tuple, List
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Tuple, List, Optional
 
-from SPARQLWrapper import SPARQLWrapper, JSON
+import requests
 from elasticsearch import Elasticsearch
 
 from data_model.kgs import DBpediaWrapperConfig
 from utils.caching import CacheWrapper, KVPair
 
-PROPERTIES_BLACKLIST = ['http://dbpedia.org/ontology/abstract',
-                        'http://dbpedia.org/ontology/wikiPageWikiLink',
-                        'http://www.w3.org/2000/01/rdf-schema#comment',
-                        'http://purl.org/dc/terms/subject',
-                        ]
-
-TYPES_BLACKLIST = ['http://www.w3.org/2002/07/owl#Thing']
+PROPERTIES_BLACKLIST = frozenset({'http://dbpedia.org/ontology/abstract',
+                                  'http://dbpedia.org/ontology/wikiPageWikiLink',
+                                  'http://www.w3.org/2000/01/rdf-schema#comment',
+                                  'http://purl.org/dc/terms/subject',
+                                  })
+
+TYPES_BLACKLIST = frozenset({'http://www.w3.org/2002/07/owl#Thing'})
+
+MGET_CHUNK_SIZE = 10000  # max number of documents retrieved by a single ES request
+ES_MAX_CONCURRENT_REQUESTS = 8
+SPARQL_MAX_CONCURRENT_REQUESTS = 4  # keep it low: public endpoints enforce per-IP quotas
+# max number of VALUES rows of a single SPARQL query (halved on failure), within the 2000 results quota
+CHUNK_ABSTRACTS = 500
+CHUNK_LABELS = 500
+CHUNK_RELATIONS = 200
+# errors reported by Virtuoso (HTTP 500) when a query is too expensive: smaller VALUES blocks may succeed
+SPARQL_QUERY_TOO_HEAVY_MESSAGES = ('estimated execution time', 'exceeds the limit', 'too large', 'timed out')
+
+# SPARQL query templates: %s placeholders are filled with the VALUES rows (and with the extra filters, if any)
+LABELS_QUERY = """
+SELECT distinct ?uri ?label
+WHERE {
+  VALUES ?uri { %s }
+  ?uri rdfs:label ?label .
+  FILTER (lang(?label) IN ("", "en"))
+}
+"""
+
+ABSTRACTS_QUERY = """
+SELECT distinct ?uri ?abstract
+WHERE {
+  VALUES ?uri { %s }
+  ?uri dbo:abstract ?abstract .
+  FILTER (lang(?abstract) = "en")
+}
+"""
+
+RELATIONS_QUERY = """
+SELECT distinct ?entity ?value ?rel
+WHERE {
+  VALUES (?entity ?value) { %s }
+  { ?entity ?rel ?aValue . }
+  UNION
+  { ?entity ?rel [rdfs:label ?aValue] . }
+  FILTER(lcase(str(?aValue))=?value)
+  %s
+}
+"""
+
+# do not let the endpoint return (and serialize) blacklisted properties
+PROPERTIES_BLACKLIST_FILTER = "FILTER(?rel NOT IN (%s))" % ", ".join("<%s>" % p for p in sorted(PROPERTIES_BLACKLIST))
+
+SUBJECTS_QUERY = """
+SELECT distinct ?subject (str(?label) as ?label)
+WHERE {
+  VALUES ?value { %s }
+  { ?subject <%s> ?value . }
+  UNION
+  { ?subject <%s> [rdfs:label ?value] . }
+  ?subject rdfs:label ?label .
+  FILTER (lang(?label) IN ("", "en"))
+}
+"""
+
+
+def _is_query_too_heavy(error: requests.RequestException) -> bool:
+    """
+    Check whether a failed SPARQL request may succeed with a smaller VALUES block.
+    Other errors (e.g., connection refused, quota exceeded, malformed query) would fail again for any size.
+    :param error: the error raised by the request
+    :return: True if the request timed out, was too long, or exceeded the time/result limits of the endpoint
+    """
+    if isinstance(error, requests.ReadTimeout):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        if error.response.status_code == 414:  # URI too long
+            return True
+        if error.response.status_code == 500:
+            message = error.response.text.lower()
+            return any(m in message for m in SPARQL_QUERY_TOO_HEAVY_MESSAGES)
+    return False
+
+
+def _sparql_literal(value: str) -> str:
+    """
+    Format a string as a SPARQL string literal, escaping the characters not allowed between quotes.
+    :param value: the string
+    :return: the quoted and escaped string
+    """
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\r', '\\r')
 
 
 class DBpediaWrapper:
@@ -23,10 +109,12 @@ class DBpediaWrapper:
 
     def __init__(self, config: DBpediaWrapperConfig = DBpediaWrapperConfig()):
         self._config = config
-        assert Elasticsearch(self._config.es_host).ping()
-
-        self._sparql = SPARQLWrapper(self._config.sparql_endpoint, defaultGraph=self._config.default_graph)
-        self._sparql.setReturnFormat(JSON)
+        self._es = None  # created lazily, see _elastic
+        self._http = None  # created lazily, see _session
+        self._clients_lock = threading.Lock()  # the first requests may come from several threads at once
+        assert self._elastic.ping()
+        # ES documents already retrieved, by (id, retrieved fields). None if missing
+        self._doc_cache: Dict[Tuple[str, Optional[Tuple[str, ...]]], Optional[dict]] = {}
 
         self._subj_cache = CacheWrapper(os.path.join(os.path.dirname(__file__), '.cache', 'DBpediaWrapper',
                                                      'subj'), int(4e9))
@@ -36,6 +124,48 @@ class DBpediaWrapper:
                                                      'type'), int(4e9))
         self._label_cache = CacheWrapper(os.path.join(os.path.dirname(__file__), '.cache', 'DBpediaWrapper',
                                                       'label'), int(4e9))
+        self._abstract_cache = CacheWrapper(os.path.join(os.path.dirname(__file__), '.cache', 'DBpediaWrapper',
+                                                         'abstract'), int(4e9))
+
+    def __getstate__(self):
+        # The ES client is not picklable: each process creates its own one (-> parallel execution)
+        state = self.__dict__.copy()
+        state['_es'] = None
+        state['_http'] = None
+        state['_doc_cache'] = {}  # do not ship cached documents to other processes
+        del state['_clients_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._clients_lock = threading.Lock()
+
+    @property
+    def _elastic(self) -> Elasticsearch:
+        """
+        ElasticSearch client, shared by all the requests of this process to reuse its connection pool.
+        :return: an Elasticsearch client
+        """
+        if self._es is None:
+            with self._clients_lock:
+                if self._es is None:
+                    self._es = Elasticsearch(self._config.es_host, http_compress=True, timeout=30, maxsize=32)
+        return self._es
+
+    @property
+    def _session(self) -> requests.Session:
+        """
+        HTTP session used to query the SPARQL endpoint, shared by all the requests of this process to keep the
+        connections alive.
+        :return: a Session object
+        """
+        if self._http is None:
+            with self._clients_lock:
+                if self._http is None:
+                    session = requests.Session()
+                    session.headers.update({'Accept': 'application/sparql-results+json'})  # gzip accepted by default
+                    self._http = session  # publish the session only when ready
+        return self._http
 
     # def _get_es_doc_by_id(self, doc_id):
     #     """
@@ -49,17 +179,118 @@ class DBpediaWrapper:
     #     except NotFoundError:
     #         return {}
 
-    def _get_es_docs_by_ids(self, docs_ids: List[str]):
+    def _iter_es_docs_by_ids(self, docs_ids: List[str], fields: Optional[List[str]] = None):
         """
         Retrieve several documents from an ElasticSearch index.
+        Documents are yielded as soon as their request completes, without accumulating the whole result set.
         :param docs_ids: ids of the documents to retrieve
-        :return: a list of tuples <doc_uri: document_dict>
-        """
-        if not docs_ids:
-            return []
-        elastic = Elasticsearch(self._config.es_host)
-        return [(doc['_id'], doc['_source'])
-                for doc in elastic.mget(body={'ids': docs_ids}, index='dbpedia')['docs'] if '_source' in doc]
+        :param fields: the fields of the documents to retrieve. Default: all the fields
+        :return: a generator of tuples <doc_uri: document_dict>
+        """
+        assert not isinstance(docs_ids, str), 'docs_ids must be a list of ids, not a single id'
+        fields = tuple(fields) if fields else None
+        docs_ids = list(dict.fromkeys(docs_ids))
+        missing = []
+        for doc_id in docs_ids:
+            if (doc_id, fields) not in self._doc_cache and (doc_id, None) in self._doc_cache:
+                self._doc_cache[(doc_id, fields)] = self._doc_cache[(doc_id, None)]  # full docs fit any fields
+            if (doc_id, fields) not in self._doc_cache:
+                missing.append(doc_id)
+            elif self._doc_cache[(doc_id, fields)] is not None:
+                yield doc_id, self._doc_cache[(doc_id, fields)]
+
+        # bound the size of requests and responses, and overlap their latency
+        chunks = [(missing[i:i + MGET_CHUNK_SIZE], fields) for i in range(0, len(missing), MGET_CHUNK_SIZE)]
+        if len(chunks) > 1:
+            with ThreadPoolExecutor(min(len(chunks), ES_MAX_CONCURRENT_REQUESTS)) as pool:
+                for response in pool.map(lambda args: self._mget(*args), chunks):
+                    yield from self._cache_docs(response, fields)
+        else:
+            for chunk in chunks:
+                yield from self._cache_docs(self._mget(*chunk), fields)
+
+    def _cache_docs(self, docs: List[dict], fields: Optional[Tuple[str, ...]] = None):
+        """
+        Store the documents of an mget response in the documents cache.
+        :param docs: the list of docs in the response
+        :param fields: the retrieved fields
+        :return: a generator of tuples <doc_uri: document_dict>, for the found documents
+        """
+        for doc in docs:
+            source = doc['_source'] if doc.get('found') else None
+            self._doc_cache[(doc['_id'], fields)] = source
+            if fields and len(fields) > 1:  # requests of single fields can be served by the same document
+                for field in fields:
+                    self._doc_cache[(doc['_id'], (field,))] = None if source is None \
+                        else {field: source[field]} if field in source else {}
+            if source is not None:
+                yield doc['_id'], source
+
+    def _mget(self, docs_ids: List[str], fields: Optional[Tuple[str, ...]] = None) -> List[dict]:
+        """
+        Execute a single mget request.
+        :param docs_ids: ids of the documents to retrieve
+        :param fields: the fields of the documents to retrieve (the lighter the response, the better).
+               Default: all the fields
+        :return: the list of docs in the response
+        """
+        params = {'_source_includes': list(fields)} if fields else {}
+        return self._elastic.mget(body={'ids': docs_ids}, index=self._config.index, **params)['docs']
+
+    def _sparql_bindings(self, query: str) -> List[dict]:
+        """
+        Execute a SPARQL query.
+        :param query: the query to execute
+        :return: the list of bindings of the results
+        """
+        response = self._session.post(self._config.sparql_endpoint,
+                                      data={'query': query, 'default-graph-uri': self._config.default_graph},
+                                      timeout=self._config.sparql_timeout)
+        response.raise_for_status()  # e.g., timeouts and too long queries -> let callers retry with smaller chunks
+        return response.json()["results"]["bindings"]
+
+    def _sparql_bindings_split(self, query: str, values: List[str],
+                               ignore_errors: bool = False) -> Tuple[List[dict], List[str]]:
+        """
+        Execute a SPARQL query with a VALUES block.
+        If the query is too heavy (e.g., timeout, too many results), retry splitting the VALUES block in two halves.
+        Any other error is raised, since smaller queries would fail as well.
+        :param query: the query template, with a placeholder for the VALUES rows
+        :param values: the VALUES rows
+        :param ignore_errors: if True, a single row still too heavy to query is skipped; otherwise, the error is raised
+        :return: a tuple (<list of bindings of the results>, <skipped VALUES rows>)
+        """
+        try:
+            return self._sparql_bindings(query % " ".join(values)), []
+        except requests.RequestException as e:
+            if not _is_query_too_heavy(e):
+                raise
+            if len(values) == 1:
+                if ignore_errors:
+                    return [], values
+                raise
+            half = len(values) // 2
+            first_bindings, first_skipped = self._sparql_bindings_split(query, values[:half], ignore_errors)
+            second_bindings, second_skipped = self._sparql_bindings_split(query, values[half:], ignore_errors)
+            return first_bindings + second_bindings, first_skipped + second_skipped
+
+    def _iter_sparql_bindings(self, query: str, values: List[str], chunk_size: int, ignore_errors: bool = False):
+        """
+        Execute a SPARQL query with a VALUES block, a chunk of values at a time.
+        Chunks are queried concurrently, to overlap their latency.
+        :param query: the query template, with a placeholder for the VALUES rows
+        :param values: the VALUES rows
+        :param chunk_size: max number of rows per query
+        :param ignore_errors: if True, skip the rows too heavy to query; otherwise, raise the error
+        :return: a generator of tuples (<list of bindings>, <skipped VALUES rows>), one per chunk
+        """
+        chunks = [values[i:i + chunk_size] for i in range(0, len(values), chunk_size)]
+        if len(chunks) > 1:
+            with ThreadPoolExecutor(min(len(chunks), SPARQL_MAX_CONCURRENT_REQUESTS)) as pool:
+                yield from pool.map(lambda chunk: self._sparql_bindings_split(query, chunk, ignore_errors), chunks)
+        else:
+            for chunk in chunks:
+                yield self._sparql_bindings_split(query, chunk, ignore_errors)
 
     def _get_abstracts_by_ids(self, docs_ids):
         """
@@ -67,7 +298,7 @@ class DBpediaWrapper:
         :param docs_ids: ids of the documents to retrieve
         :return: a dictionary Dict(doc_id: List(abstracts))
         """
-        return {doc_id: doc['description'] for doc_id, doc in self._get_es_docs_by_ids(docs_ids)}
+        return {doc_id: doc['description'] for doc_id, doc in self._iter_es_docs_by_ids(docs_ids, ['description'])}
 
     def _get_attribute_for_uris(self, uris, attribute, default_value):
         """
@@ -77,15 +308,9 @@ class DBpediaWrapper:
         :param default_value: value to set if the selected attribute is missing
         :return: a dict uri: values
         """
-        docs = self._get_es_docs_by_ids(uris)
-        attributes = {}
-        for uri, doc in docs:
-            if attribute in doc:
-                attributes[uri] = doc[attribute]
-        for uri in uris:
-            if uri not in attributes:
-                attributes[uri] = default_value
-        return attributes
+        attributes = {uri: doc[attribute] for uri, doc in self._iter_es_docs_by_ids(uris, [attribute])
+                      if attribute in doc}
+        return {uri: attributes.get(uri, default_value) for uri in uris}
 
     def get_labels_for_uris(self, uris):
         """
@@ -95,22 +320,22 @@ class DBpediaWrapper:
         :return: a dict uri: labels
         """
         labels = self._get_attribute_for_uris(uris, 'surface_form_keyword', [])
-        missing = [uri for uri in labels if not labels[uri]]
-        for uri in missing:  # TODO bulk query with VALUES
-            cached = self._label_cache.get_cached_entry(uri)
-            if cached:
-                labels[uri] = cached
-            self._sparql.setQuery("""
-                    SELECT distinct ?label
-                    WHERE {
-                      <%s> rdfs:label ?label .
-                    FILTER (langMatches(lang(?label), "EN") || langMatches(lang(?label), "")) }
-                    """ % uri)
-
-            result = [result["label"]["value"]
-                      for result in self._sparql.query().convert()["results"]["bindings"]]
-            self._label_cache.set_entry(KVPair(uri, result))
-            labels[uri] = result
+        missing = []
+        for uri in labels:
+            if not labels[uri]:
+                cached = self._label_cache.get_cached_entry(uri)
+                if cached is None:  # empty lists are cached too: do not ask again for entities without labels
+                    missing.append(uri)
+                else:
+                    labels[uri] = cached
+
+        results = {uri: [] for uri in missing}
+        for bindings, _ in self._iter_sparql_bindings(LABELS_QUERY, ["<%s>" % uri for uri in missing], CHUNK_LABELS):
+            for result in bindings:
+                results[result["uri"]["value"]].append(result["label"]["value"])
+
+        self._label_cache.update_cache_entries([KVPair(uri, result) for uri, result in results.items()])
+        labels.update(results)
         return labels
 
     def fetch_long_abstracts(self, uris):
@@ -120,23 +345,17 @@ class DBpediaWrapper:
         :param uris: list of URIs
         :return: a dictionary Dict(uri, abstract)
         """
-        # TODO: cache
-        results = []
+        cached_entries, to_compute = self._abstract_cache.get_cached_entries(list(dict.fromkeys(uris)))
+        results = {uri: None for uri in to_compute}  # None -> no abstract, do not ask again
 
-        for i in range(0, len(uris), 25):
-            uris_list = " ".join(map(lambda x: "<%s>" % x, uris[i:i + 25]))
-            self._sparql.setQuery("""
-            SELECT distinct ?uri ?abstract {
-              VALUES ?uri { %s }
-              ?uri dbo:abstract ?abstract .
-              FILTER langMatches( lang(?abstract), "EN" )
-            }
-            """ % uris_list)
+        values = ["<%s>" % uri for uri in to_compute]
+        for bindings, _ in self._iter_sparql_bindings(ABSTRACTS_QUERY, values, CHUNK_ABSTRACTS):
+            for result in bindings:
+                results[result["uri"]["value"]] = result["abstract"]["value"]
 
-            results += [(result["uri"]["value"], result["abstract"]["value"])
-                        for result in self._sparql.query().convert()["results"]["bindings"]]
-
-        return dict(results)
+        self._abstract_cache.update_cache_entries([KVPair(uri, (uri, results[uri])) for uri in to_compute])
+        results.update(dict(cached_entries))
+        return {uri: abstract for uri, abstract in results.items() if abstract is not None}
 
     def fetch_short_abstracts(self, uris):
         """
@@ -157,42 +376,22 @@ class DBpediaWrapper:
         :return: a dict subj_obj_pair: [properties]
         """
 
-        query = """
-        SELECT distinct ?entity ?value ?rel
-            WHERE {
-              VALUES (?entity ?value) {
-                  %s
-              }
-              { ?entity ?rel ?aValue . }
-              UNION
-              { ?entity ?rel [rdfs:label ?aValue] . }
-              FILTER(lcase(str(?aValue))=?value)
-            }
-        """
-
         cached_entries, to_compute = self._rels_cache.get_cached_entries(subj_obj_pairs)
-        results = {key: [] for key in to_compute}
-
-        chunk_sizes = [x ** 2 for x in range(5, 0, -1)]  # handle too long queries
-        for chunk_size in chunk_sizes:
-            retry = False
-            for i in range(0, len(to_compute), chunk_size):
-                query_values = " ".join(map(lambda x: '(<%s> "%s")' % (x[0], x[1].replace('"', '\\"')),
-                                            to_compute[i:i + chunk_size]))
-                self._sparql.setQuery(query % query_values)
-                try:
-                    for result in self._sparql.query().convert()["results"]["bindings"]:
-                        key, value = (result['entity']['value'], result["value"]['value']), result["rel"]['value']
-                        if not (filter_blacklisted and value in PROPERTIES_BLACKLIST):
-                            results[key].append(value)
-                except:  # if an error occurs, retry with smaller chunks
-                    retry = True
-                    break
-            if not retry:
-                break
 
+        results = {key: [] for key in to_compute}
+        query = RELATIONS_QUERY % ('%s', PROPERTIES_BLACKLIST_FILTER if filter_blacklisted else '')
+        values = {"(<%s> %s)" % (subj, _sparql_literal(obj)): (subj, obj) for subj, obj in to_compute}
+        skipped = set()
+        for bindings, skipped_values in self._iter_sparql_bindings(query, list(values), CHUNK_RELATIONS,
+                                                                   ignore_errors=True):
+            for result in bindings:
+                key, value = (result['entity']['value'], result["value"]['value']), result["rel"]['value']
+                results[key].append(value)
+            skipped.update(values[v] for v in skipped_values)
+
+        # pairs that could not be queried are not cached: they will be retried next time
         self._rels_cache.update_cache_entries([KVPair(sub_obj_pair, (sub_obj_pair, results[sub_obj_pair]))
-                                               for sub_obj_pair in to_compute])
+                                               for sub_obj_pair in to_compute if sub_obj_pair not in skipped])
         if cached_entries:
             results.update(dict(cached_entries))
         return results
@@ -242,6 +441,17 @@ class DBpediaWrapper:
         """
         return self._get_attribute_for_uris(uris, 'description', [])
 
+    def get_entity_info(self, uris):
+        """
+        Get the labels, types and descriptions of a given list of entities, with a single round trip to ES.
+
+        :param uris: a list of URIs
+        :return: a tuple of dicts (uri: labels, uri: types, uri: descriptions)
+        """
+        for _ in self._iter_es_docs_by_ids(uris, ['surface_form_keyword', 'type', 'description']):
+            pass  # fill the documents cache, the following requests are served by it
+        return self.get_labels_for_uris(uris), self.get_types_for_uris(uris), self.get_descriptions_for_uris(uris)
+
     def get_uri_count_for_uris(self, uris):
         """
         Get the uri_count field of a list of documents (from Spotlight lexicalizations)
@@ -306,29 +516,18 @@ class DBpediaWrapper:
          - value.title()
         """
 
-        cached = self._subj_cache.get_cached_entry((prop, value))
-        if cached:
+        variants = {value.lower(), value.upper(), value.capitalize(), value.title()}
+        # differently-cased values with the same variants share the same query -> share the same cache entry
+        key = (prop, value.lower() if value in variants else value)
+        cached = self._subj_cache.get_cached_entry(key)
+        if cached is not None:  # subjects not found are cached too
             return cached
-        val = value.replace('"', '\\"')
-        words_set = {'"%s"' % v for v in {val, val.lower(), val.upper(), val.capitalize(), val.title()}}
+        words_set = {_sparql_literal(v) for v in variants | {value}}
         words_set.update(["%s@en" % w for w in words_set])
-        query = """
-        SELECT distinct ?subject (str(?label) as ?label)
-        WHERE {
-          VALUES ?value {%s}
-          { ?subject <%s> ?value . }
-          UNION
-          { ?subject <%s> [rdfs:label ?value] . }
-          ?subject rdfs:label ?label .
-          FILTER (langMatches(lang(?label), "EN") || langMatches(lang(?label), ""))
-        }""" % (" ".join(words_set), prop, prop)
-        self._sparql.setQuery(query)
-        results = {}
-        for result in self._sparql.query().convert()["results"]["bindings"]:
-            subject, label = result["subject"]["value"], result["label"]["value"]
-            if subject not in results:
-                results[subject] = []
-            results[subject].append(label)
-
-        self._subj_cache.set_entry(KVPair((prop, value), results))
+        results = defaultdict(list)
+        for result in self._sparql_bindings(SUBJECTS_QUERY % (" ".join(words_set), prop, prop)):
+            results[result["subject"]["value"]].append(result["label"]["value"])
+        results = dict(results)
+
+        self._subj_cache.set_entry(KVPair(key, results))
         return results